@@ -14,8 +14,9 @@ import os
 import logging
 import argparse
 import base64
+from collections import Counter
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 # PDF libraries
 import fitz  # PyMuPDF
@@ -23,63 +24,116 @@ import markitdown
 
 logging.basicConfig(level=logging.INFO)
 
+# MarkItDown instance shared by all fallback conversions, created on first use
+_markitdown = None
+
+# Per-page heading, formatted straight to bytes for the binary output file
+PAGE_HEADER = b"### Page %d\n\n"
+
+# Large output buffer so a document is written in few big syscalls
+OUTPUT_BUFFER_SIZE = 4 << 20
+
+# Multiple of 3 so each chunk base64-encodes without padding
+BASE64_CHUNK_SIZE = 48 * 1024
+
+
+def write_base64(out_file, data: bytes):
+    """Base64-encode data into the binary out_file chunk by chunk"""
+    view = memoryview(data)
+    for start in range(0, len(view), BASE64_CHUNK_SIZE):
+        out_file.write(base64.b64encode(view[start:start + BASE64_CHUNK_SIZE]))
+
+
+def count_image_uses(doc) -> Counter:
+    """Count how many times each image xref is placed across the document"""
+    return Counter(img[0] for page in doc for img in page.get_images(full=False))
+
 
 def convert_pdf_with_pymupdf(pdf_path: Path, output_path: Path,
                               image_folder: Optional[Path] = None,
                               embed_images: bool = False,
                               image_format: str = "png",
                               dpi: int = 300) -> bool:
+    doc = None
+    # Write to a sibling file and move it into place only once the whole
+    # document converted, so a failure never leaves a truncated Markdown file
+    partial_path = output_path.with_name(output_path.name + ".part")
     try:
         logging.info(f"Converting with PyMuPDF: {pdf_path} -> {output_path}")
         doc = fitz.open(str(pdf_path))
-        markdown_parts = []
-
         image_count = 0
-
-        for page_num, page in enumerate(doc, start=1):
-            text = page.get_text()
-            markdown_parts.append(f"### Page {page_num}\n\n{text}\n")
-
-            images = page.get_images(full=True)
-            for img_index, img in enumerate(images):
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                img_bytes = base_image["image"]
-                img_ext = base_image["ext"]
-
-                image_count += 1
-                image_filename = f"image_{page_num:03d}_{img_index+1:02d}.{img_ext}"
-
-                if embed_images:
-                    encoded = base64.b64encode(img_bytes).decode()
-                    markdown_parts.append(
-                        f"![Image](data:image/{img_ext};base64,{encoded})\n"
-                    )
-                else:
-                    # Create images folder in the same directory as the markdown file
-                    image_folder.mkdir(parents=True, exist_ok=True)
-                    image_path = image_folder / image_filename
-                    with open(image_path, "wb") as img_out:
-                        img_out.write(img_bytes)
-                    # Use relative path from markdown to images folder
-                    rel_path = f"images/{image_filename}"
-                    markdown_parts.append(f"![Image]({rel_path})\n")
-
-        with open(output_path, "w", encoding="utf-8") as md_file:
-            md_file.write("\n".join(markdown_parts))
-
+        # Images reused across pages (logos, backgrounds) are only extracted and
+        # written once: xref -> relative path, or xref -> (bytes, ext) when embedding.
+        # Embedded bytes are kept only while later pages still place the image
+        saved_images: Dict[int, str] = {}
+        embedded_images: Dict[int, Tuple[bytes, str]] = {}
+        image_uses = count_image_uses(doc) if embed_images else Counter()
+
+        with open(partial_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as md_file:
+            for page_num, page in enumerate(doc, start=1):
+                # Write each page as it is extracted so only one page is held in memory
+                md_file.write(PAGE_HEADER % page_num)
+                md_file.write(page.get_text().encode("utf-8", "replace"))
+                md_file.write(b"\n\n")
+
+                images = page.get_images(full=False)
+                for img_index, img in enumerate(images):
+                    xref = img[0]
+                    image_count += 1
+
+                    if xref in saved_images:
+                        md_file.write(f"![Image]({saved_images[xref]})\n\n".encode("utf-8"))
+                        continue
+                    if xref in embedded_images:
+                        img_bytes, img_ext = embedded_images[xref]
+                    else:
+                        base_image = doc.extract_image(xref)
+                        img_bytes = base_image["image"]
+                        img_ext = base_image["ext"]
+
+                    image_filename = f"image_{page_num:03d}_{img_index+1:02d}.{img_ext}"
+
+                    if embed_images:
+                        image_uses[xref] -= 1
+                        if image_uses[xref] > 0:
+                            embedded_images[xref] = (img_bytes, img_ext)
+                        else:
+                            embedded_images.pop(xref, None)
+                        md_file.write(f"![Image](data:image/{img_ext};base64,".encode())
+                        write_base64(md_file, img_bytes)
+                        md_file.write(b")\n\n")
+                    else:
+                        # Create images folder in the same directory as the markdown file
+                        image_folder.mkdir(parents=True, exist_ok=True)
+                        image_path = image_folder / image_filename
+                        with open(image_path, "wb") as img_out:
+                            img_out.write(img_bytes)
+                        # Use relative path from markdown to images folder
+                        rel_path = f"images/{image_filename}"
+                        saved_images[xref] = rel_path
+                        md_file.write(f"![Image]({rel_path})\n\n".encode("utf-8"))
+
+        os.replace(partial_path, output_path)
         logging.info(f"PyMuPDF converted {pdf_path.name} with {image_count} images.")
         return True
 
     except Exception as e:
         logging.error(f"PyMuPDF failed on {pdf_path}: {e}")
+        partial_path.unlink(missing_ok=True)
         return False
 
+    finally:
+        if doc is not None:
+            doc.close()
+
 
 def convert_pdf_with_markitdown(pdf_path: Path, output_path: Path):
+    global _markitdown
     logging.info(f"Converting with markitdown: {pdf_path} -> {output_path}")
     try:
-        output = markitdown.convert(str(pdf_path))
+        if _markitdown is None:
+            _markitdown = markitdown.MarkItDown()
+        output = _markitdown.convert(str(pdf_path)).text_content
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(output)
     except Exception as e:
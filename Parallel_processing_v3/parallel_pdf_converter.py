@@ -8,14 +8,35 @@ Usage:
     python parallel_pdf_converter.py source_dir output_dir [--embed-images] [--workers N]
 """
 
+import sys
+import json
+import time
 import logging
 import argparse
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+
+# Import the heavy PDF libraries up front so forked workers inherit them
+# instead of re-importing them on startup
+import fitz  # noqa: F401
+import markitdown  # noqa: F401
+
+# Optional: used to size the process pool from measured worker memory
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Unix only: peak memory of the worker process
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Import our PDF converter class
-from pdf_converter import PDFConverter
+from pdf_converter import PDFConverter, iter_pdf_files
 
 # Configure logging for multiprocessing
 logging.basicConfig(
@@ -23,15 +44,34 @@ logging.basicConfig(
     format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s'
 )
 
+# Measured per-worker memory, reused across runs to skip the warm-up worker
+WORKER_ESTIMATE_CACHE = Path.home() / ".cache" / "pdf_converter" / "worker_estimate.json"
+
+# A cached measurement is reused only while it is this recent and was taken
+# on a median PDF within this size ratio of the current batch's median
+WORKER_ESTIMATE_MAX_AGE = 7 * 24 * 3600
+WORKER_ESTIMATE_MAX_SIZE_RATIO = 2.0
+
+# Headroom on top of the measured worker memory for larger-than-median PDFs
+WORKER_RSS_HEADROOM = 1.3
+
+
+# Converter shared by every file a worker handles, set up by _init_worker
+_WORKER_CONV = None
+
 
-def process_single_pdf(pdf_info: Tuple[Path, Path, Path, bool]) -> bool:
+def _init_worker(embed_images: bool):
+    """Pool initializer - create this worker's converter once"""
+    global _WORKER_CONV
+    _WORKER_CONV = PDFConverter(embed_images=embed_images)
+
+
+def process_single_pdf(pdf_info: Tuple[Path, Path, Path]) -> bool:
     """Process a single PDF file - worker function for multiprocessing"""
-    pdf_path, source_dir, output_dir, embed_images = pdf_info
+    pdf_path, source_dir, output_dir = pdf_info
     
     try:
-        # Create converter instance for this worker
-        converter = PDFConverter(embed_images=embed_images)
-        converter.process_pdf(pdf_path, source_dir, output_dir)
+        _WORKER_CONV.process_pdf(pdf_path, source_dir, output_dir)
         return True
         
     except Exception as e:
@@ -39,12 +79,137 @@ def process_single_pdf(pdf_info: Tuple[Path, Path, Path, bool]) -> bool:
         return False
 
 
+def _peak_rss() -> int:
+    """Peak resident memory of this process so far, in bytes"""
+    if resource is None:
+        # Windows: psutil reports the peak working set directly
+        return psutil.Process().memory_info().peak_wset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _process_and_measure(pdf_info: Tuple[Path, Path, Path]) -> Tuple[bool, int]:
+    """
+    Process a PDF and report how much memory the conversion needed.
+    
+    Measures the growth of the worker's peak RSS over its pre-task baseline.
+    The baseline is mostly the parent's pages shared copy-on-write after a
+    fork, so counting it per worker would overstate the pool's footprint.
+    """
+    baseline = _peak_rss()
+    success = process_single_pdf(pdf_info)
+    return success, max(1, _peak_rss() - baseline)
+
+
+def measure_worker_rss(ctx, pdf_info: Tuple[Path, Path, Path],
+                       embed_images: bool) -> Tuple[bool, int]:
+    """Convert one PDF in a fresh worker process, returning (success, peak bytes)"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(embed_images,)) as executor:
+        return executor.submit(_process_and_measure, pdf_info).result()
+
+
+def load_cached_worker_rss(embed_images: bool,
+                           median_bytes: Optional[int] = None) -> Optional[int]:
+    """
+    Return the worker RSS measured by a previous run, if it still applies.
+    
+    Measurements older than WORKER_ESTIMATE_MAX_AGE are ignored, as are ones
+    taken on a median PDF of very different size than median_bytes (a text-only
+    batch says little about an image-heavy one).
+    """
+    try:
+        with open(WORKER_ESTIMATE_CACHE, "r", encoding="utf-8") as f:
+            entry = json.load(f).get(_worker_rss_key(embed_images))
+        if not isinstance(entry, dict):
+            return None
+        if time.time() - entry["measured_at"] > WORKER_ESTIMATE_MAX_AGE:
+            return None
+        if median_bytes is not None:
+            low, high = sorted((max(1, median_bytes), max(1, entry["median_bytes"])))
+            if high / low > WORKER_ESTIMATE_MAX_SIZE_RATIO:
+                return None
+        return entry["peak_bytes"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cached_worker_rss(embed_images: bool, worker_rss: int, median_bytes: int):
+    """Store the measured worker memory, with the median PDF size it was taken on"""
+    try:
+        WORKER_ESTIMATE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(WORKER_ESTIMATE_CACHE, "r", encoding="utf-8") as f:
+                estimates = json.load(f)
+        except (OSError, ValueError):
+            estimates = {}
+        estimates[_worker_rss_key(embed_images)] = {
+            "peak_bytes": worker_rss,
+            "median_bytes": median_bytes,
+            "measured_at": time.time(),
+        }
+        with open(WORKER_ESTIMATE_CACHE, "w", encoding="utf-8") as f:
+            json.dump(estimates, f)
+    except OSError as e:
+        logging.warning(f"Could not cache worker estimate: {e}")
+
+
+def _worker_rss_key(embed_images: bool) -> str:
+    # Embedding holds image data in memory, so it is measured separately
+    return "embed_images_rss" if embed_images else "image_files_rss"
+
+
+def estimate_workers_from_rss(worker_rss: int, max_workers: int) -> int:
+    """Fit as many workers of the measured size as available memory allows"""
+    return estimate_optimal_workers(psutil.virtual_memory().available,
+                                    max_workers, worker_rss)
+
+
+def get_mp_context():
+    """
+    Pick a multiprocessing start method that avoids re-importing in workers.
+    
+    With "fork" the workers share the parent's already-imported PyMuPDF and
+    markitdown modules copy-on-write, skipping the per-worker interpreter
+    startup (~300ms each) that "spawn" pays. macOS uses "forkserver" since
+    forking a process that has touched system frameworks is unsafe there;
+    the server preloads the same modules once. Windows only supports spawn.
+    """
+    methods = mp.get_all_start_methods()
+    if sys.platform == "darwin" and "forkserver" in methods:
+        ctx = mp.get_context("forkserver")
+        ctx.set_forkserver_preload(["fitz", "markitdown", "pdf_converter"])
+        return ctx
+    if "fork" in methods:
+        return mp.get_context("fork")
+    return mp.get_context("spawn")
+
+
 def collect_pdf_files(source_dir: Path) -> List[Path]:
-    """Collect all PDF files from the source directory recursively"""
-    pdf_files = []
-    for pdf_path in source_dir.rglob("*.pdf"):
-        pdf_files.append(pdf_path)
-    return pdf_files
+    """
+    Collect all PDF files from the source directory recursively.
+    
+    Files are returned largest first so the slowest conversions start early
+    and small files fill in the tail, instead of a big file being picked up
+    last and leaving the other workers idle.
+    """
+    sized_files = []
+    for pdf_path in iter_pdf_files(source_dir):
+        try:
+            size = pdf_path.stat().st_size
+        except OSError as e:
+            # e.g. a dangling symlink: keep it so it fails on its own later
+            logging.warning(f"Cannot stat {pdf_path}: {e}")
+            size = 0
+        sized_files.append((size, pdf_path))
+    sized_files.sort(key=lambda item: item[0], reverse=True)
+    
+    total_bytes = sum(size for size, _ in sized_files)
+    logging.info(f"Total PDF data to process: {total_bytes / (1024 * 1024):.1f} MB")
+    
+    return [pdf_path for _, pdf_path in sized_files]
 
 
 def process_pdfs_parallel(source_dir: Path, output_dir: Path, 
@@ -61,52 +226,98 @@ def process_pdfs_parallel(source_dir: Path, output_dir: Path,
     
     logging.info(f"Found {total_files} PDF files to process")
     
-    # Determine number of workers
-    if num_workers is None:
-        num_workers = min(mp.cpu_count(), total_files)
-    
-    logging.info(f"Using {num_workers} worker processes")
+    # Determine number of workers, never more than there are files
+    auto_workers = num_workers is None
+    if auto_workers:
+        num_workers = mp.cpu_count()
+    num_workers = max(1, min(num_workers, total_files))
     
     # Prepare arguments for worker processes
     pdf_info_list = [
-        (pdf_path, source_dir, output_dir, embed_images)
+        (pdf_path, source_dir, output_dir)
         for pdf_path in pdf_files
     ]
     
-    # Process files in parallel
-    with mp.Pool(processes=num_workers) as pool:
+    # Pool startup dominates for tiny batches, so run them inline
+    if total_files <= 2 or num_workers == 1:
+        logging.info("Small batch: processing inline without a worker pool")
+        _init_worker(embed_images)
+        successful = sum(process_single_pdf(pdf_info) for pdf_info in pdf_info_list)
+        logging.info(f"Successfully processed {successful}/{total_files} PDF files")
+        return
+    
+    successful = 0
+    completed = 0
+    
+    ctx = get_mp_context()
+    
+    # Size the pool from what a worker actually uses on this batch: run
+    # the median-sized file in a single warm-up worker and measure it
+    if auto_workers and psutil is not None:
+        median_index = len(pdf_info_list) // 2
         try:
-            results = pool.map(process_single_pdf, pdf_info_list)
-            successful = sum(results)
-            logging.info(f"Successfully processed {successful}/{total_files} PDF files")
-            
-        except KeyboardInterrupt:
-            logging.info("Process interrupted by user")
-            pool.terminate()
-            pool.join()
-        except Exception as e:
-            logging.error(f"Error in parallel processing: {e}")
-            pool.terminate()
-            pool.join()
-
-
-def estimate_optimal_workers(memory_gb: int = 128, cpu_cores: int = 12) -> int:
+            median_bytes = pdf_info_list[median_index][0].stat().st_size
+        except OSError:
+            median_bytes = 0
+        worker_rss = load_cached_worker_rss(embed_images, median_bytes)
+        if worker_rss is None:
+            sample_info = pdf_info_list[median_index]
+            logging.info(f"Measuring worker memory on {sample_info[0].name}")
+            try:
+                sample_ok, worker_rss = measure_worker_rss(ctx, sample_info, embed_images)
+            except Exception as e:
+                # Leave the sample in the batch and keep the CPU-count sizing
+                logging.warning(f"Worker memory measurement failed: {e}")
+            else:
+                del pdf_info_list[median_index]
+                completed += 1
+                successful += sample_ok
+                save_cached_worker_rss(embed_images, worker_rss, median_bytes)
+        if worker_rss is not None:
+            num_workers = estimate_workers_from_rss(worker_rss, num_workers)
+            logging.info(f"Peak worker memory {worker_rss / (1024 * 1024):.0f} MB "
+                         f"allows {num_workers} worker processes")
+    
+    logging.info(f"Using {num_workers} worker processes "
+                 f"(start method: {ctx.get_start_method()})")
+    
+    # Process files in parallel, consuming results as they stream back
+    executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                                   initializer=_init_worker,
+                                   initargs=(embed_images,))
+    try:
+        # Files are sorted largest first and submitted one at a time, so big
+        # files spread across workers; results are counted in completion order
+        futures = [executor.submit(process_single_pdf, pdf_info)
+                   for pdf_info in pdf_info_list]
+        for future in as_completed(futures):
+            completed += 1
+            if future.result():
+                successful += 1
+            logging.info(f"Progress: {completed}/{total_files} PDF files done")
+        executor.shutdown(wait=True)
+        logging.info(f"Successfully processed {successful}/{total_files} PDF files")
+        
+    except KeyboardInterrupt:
+        logging.info("Process interrupted by user")
+        executor.shutdown(wait=False, cancel_futures=True)
+    except Exception as e:
+        logging.error(f"Error in parallel processing: {e}")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def estimate_optimal_workers(available_bytes: int, cpu_cores: int,
+                             worker_bytes: int) -> int:
     """
     Estimate optimal number of worker processes based on system resources.
     
-    PDF processing is primarily CPU-intensive with moderate memory usage.
-    Each worker might use 100-500MB of RAM depending on PDF size and complexity.
+    PDF processing is CPU-bound, so there is no gain past one worker per core;
+    below that, the pool is limited to what fits in available memory at
+    worker_bytes (plus headroom) per worker. Both the auto-sized run and
+    --estimate-workers go through this, so they agree.
     """
-    # Conservative memory estimate: 400MB per worker process
-    memory_based_limit = (memory_gb * 1024) // 400  # Convert GB to MB, divide by 400MB
-    
-    # CPU-based limit: typically 1-2x CPU cores for CPU-intensive tasks
-    cpu_based_limit = int(cpu_cores * 1.5)
-    
-    # Take the minimum to avoid resource exhaustion
-    optimal = min(memory_based_limit, cpu_based_limit, 32)  # Cap at 32 processes
-    
-    return max(1, optimal)
+    memory_based_limit = int(available_bytes // (worker_bytes * WORKER_RSS_HEADROOM))
+    return max(1, min(cpu_cores, memory_based_limit))
 
 
 if __name__ == "__main__":
@@ -127,9 +338,18 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     if args.estimate_workers:
-        # For M4 Max: 12 CPU cores, 128GB RAM
-        optimal = estimate_optimal_workers(memory_gb=128, cpu_cores=12)
-        print(f"Estimated optimal worker processes for M4 Max (128GB RAM, 12 cores): {optimal}")
+        worker_rss = load_cached_worker_rss(args.embed_images) if psutil is not None else None
+        if worker_rss is not None:
+            # Measured by a previous run on this machine; same sizing as a real run
+            optimal = estimate_workers_from_rss(worker_rss, mp.cpu_count())
+            print(f"Estimated optimal worker processes from measured worker memory "
+                  f"({worker_rss / (1024 * 1024):.0f}MB per worker, "
+                  f"{mp.cpu_count()} cores): {optimal}")
+        else:
+            # Static guess for M4 Max: 12 CPU cores, 128GB RAM, 400MB per worker
+            optimal = estimate_optimal_workers(128 * 1024 ** 3, 12, 400 * 1024 ** 2)
+            print(f"Static estimate for M4 Max (128GB RAM, 12 cores, assumed 400MB "
+                  f"per worker; no measured worker memory cached): {optimal}")
         print(f"Conservative recommendation: {optimal // 2}")
         print(f"Aggressive recommendation: {optimal}")
         exit(0)
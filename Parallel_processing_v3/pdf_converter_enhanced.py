@@ -14,8 +14,9 @@ import os
 import logging
 import argparse
 import base64
+from collections import Counter
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Set, Tuple
 
 # PDF libraries
 import fitz  # PyMuPDF
@@ -23,68 +24,187 @@ import markitdown
 
 logging.basicConfig(level=logging.INFO)
 
+# Empty MuPDF's global font/image store after this many documents so a
+# long-running worker does not keep growing its cache across files
+STORE_SHRINK_INTERVAL = 10
+
+# Per-page heading, formatted straight to bytes for the binary output file
+PAGE_HEADER = b"### Page %d\n\n"
+
+# Large output buffer so a document is written in few big syscalls
+OUTPUT_BUFFER_SIZE = 4 << 20
+
+# Multiple of 3 so each chunk base64-encodes without padding
+BASE64_CHUNK_SIZE = 48 * 1024
+
+
+def write_base64(out_file, data: bytes):
+    """Base64-encode data into the binary out_file chunk by chunk"""
+    view = memoryview(data)
+    for start in range(0, len(view), BASE64_CHUNK_SIZE):
+        out_file.write(base64.b64encode(view[start:start + BASE64_CHUNK_SIZE]))
+
+
+def count_image_uses(doc) -> Counter:
+    """Count how many times each image xref is placed across the document"""
+    return Counter(img[0] for page in doc for img in page.get_images(full=False))
+
+
+def write_image_file(image_path: Path, data: bytes):
+    """Write one image with a raw fd, skipping file-object overhead"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(image_path, flags, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def prefetch_file(path: Path):
+    """Ask the kernel to start reading a file into the page cache ahead of use"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+# Directories already created by this process, so repeated files and pages
+# in the same folder skip the mkdir syscall
+_MKDIR_CACHE: Set[Path] = set()
+
+
+def ensure_dir(path: Path):
+    """Create path (and parents) unless this process already did"""
+    if path not in _MKDIR_CACHE:
+        path.mkdir(parents=True, exist_ok=True)
+        _MKDIR_CACHE.add(path)
+
+
+def iter_pdf_files(root):
+    """Yield PDF files under root recursively using os.scandir's cached entry types"""
+    # Like os.walk, skip directories that can't be read instead of aborting
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_pdf_files(entry.path)
+                elif entry.name[-4:].lower() == ".pdf":
+                    yield Path(entry.path)
+    except OSError as e:
+        logging.warning(f"Skipping unreadable directory {root}: {e}")
+
 
 class PDFConverter:
     """PDF to Markdown converter with image extraction capabilities"""
     
-    def __init__(self, embed_images: bool = False, image_format: str = "png", dpi: int = 300):
+    def __init__(self, embed_images: bool = False):
         self.embed_images = embed_images
-        self.image_format = image_format
-        self.dpi = dpi
+        self.docs_since_shrink = 0
+        # MarkItDown instance shared by all fallback conversions, created on first use
+        self.markitdown = None
 
 
     def convert_pdf_with_pymupdf(self, pdf_path: Path, output_path: Path,
                                   image_folder: Optional[Path] = None) -> bool:
+        doc = None
+        # Write to a sibling file and move it into place only once the whole
+        # document converted, so a failure never leaves a truncated Markdown file
+        partial_path = output_path.with_name(output_path.name + ".part")
         try:
             logging.info(f"Converting with PyMuPDF: {pdf_path} -> {output_path}")
+            prefetch_file(pdf_path)
             doc = fitz.open(str(pdf_path))
-            markdown_parts = []
-            image_count = 0
-
-            for page_num, page in enumerate(doc, start=1):
-                text = page.get_text()
-                markdown_parts.append(f"### Page {page_num}\n\n{text}\n")
-
-                images = page.get_images(full=True)
-                for img_index, img in enumerate(images):
-                    xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    img_bytes = base_image["image"]
-                    img_ext = base_image["ext"]
-
-                    image_count += 1
-                    image_filename = f"image_{page_num:03d}_{img_index+1:02d}.{img_ext}"
-
-                    if self.embed_images:
-                        encoded = base64.b64encode(img_bytes).decode()
-                        markdown_parts.append(
-                            f"![Image](data:image/{img_ext};base64,{encoded})\n"
-                        )
-                    else:
-                        # Create images folder in the same directory as the markdown file
-                        image_folder.mkdir(parents=True, exist_ok=True)
-                        image_path = image_folder / image_filename
-                        with open(image_path, "wb") as img_out:
-                            img_out.write(img_bytes)
-                        # Use relative path from markdown to images folder
-                        rel_path = f"images/{image_filename}"
-                        markdown_parts.append(f"![Image]({rel_path})\n")
-
-            with open(output_path, "w", encoding="utf-8") as md_file:
-                md_file.write("\n".join(markdown_parts))
-
+            # Images reused across pages (logos, backgrounds) are only extracted and
+            # written once: xref -> relative path, or xref -> (bytes, ext) when embedding.
+            # Embedded bytes are kept only while later pages still place the image
+            saved_images: Dict[int, str] = {}
+            embedded_images: Dict[int, Tuple[bytes, str]] = {}
+            image_uses = count_image_uses(doc) if self.embed_images else Counter()
+
+            with open(partial_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as md_file:
+                image_count = 0
+                for page_num, page in enumerate(doc, start=1):
+                    # Write each page as it is extracted so only one page is held in memory
+                    image_count += self.write_page(doc, page, page_num, md_file,
+                                                   image_folder, saved_images,
+                                                   embedded_images, image_uses)
+
+            os.replace(partial_path, output_path)
             logging.info(f"PyMuPDF converted {pdf_path.name} with {image_count} images.")
-            doc.close()
             return True
 
         except Exception as e:
             logging.error(f"PyMuPDF failed on {pdf_path}: {e}")
+            partial_path.unlink(missing_ok=True)
             return False
 
+        finally:
+            if doc is not None:
+                doc.close()
+                self.docs_since_shrink += 1
+                if self.docs_since_shrink >= STORE_SHRINK_INTERVAL:
+                    fitz.TOOLS.store_shrink(100)
+                    self.docs_since_shrink = 0
+
+    def write_page(self, doc, page, page_num: int, md_file,
+                   image_folder: Optional[Path], saved_images: Dict[int, str],
+                   embedded_images: Dict[int, Tuple[bytes, str]],
+                   image_uses: Counter) -> int:
+        """Write one page's text and images to md_file, returning its image count"""
+        md_file.write(PAGE_HEADER % page_num)
+        md_file.write(page.get_text().encode("utf-8", "replace"))
+        md_file.write(b"\n\n")
+
+        images = page.get_images(full=False)
+        for img_index, img in enumerate(images):
+            xref = img[0]
+
+            if xref in saved_images:
+                md_file.write(f"![Image]({saved_images[xref]})\n\n".encode("utf-8"))
+                continue
+            if xref in embedded_images:
+                img_bytes, img_ext = embedded_images[xref]
+            else:
+                base_image = doc.extract_image(xref)
+                img_bytes = base_image["image"]
+                img_ext = base_image["ext"]
+
+            image_filename = f"image_{page_num:03d}_{img_index+1:02d}.{img_ext}"
+
+            if self.embed_images:
+                image_uses[xref] -= 1
+                if image_uses[xref] > 0:
+                    embedded_images[xref] = (img_bytes, img_ext)
+                else:
+                    embedded_images.pop(xref, None)
+                md_file.write(f"![Image](data:image/{img_ext};base64,".encode())
+                write_base64(md_file, img_bytes)
+                md_file.write(b")\n\n")
+            else:
+                # Create images folder in the same directory as the markdown file
+                ensure_dir(image_folder)
+                write_image_file(image_folder / image_filename, img_bytes)
+                # Use relative path from markdown to images folder
+                rel_path = f"images/{image_filename}"
+                saved_images[xref] = rel_path
+                md_file.write(f"![Image]({rel_path})\n\n".encode("utf-8"))
+
+        return len(images)
+
     def convert_pdf_with_markitdown(self, pdf_path: Path, output_path: Path):
         logging.info(f"Converting with markitdown: {pdf_path} -> {output_path}")
         try:
-            output = markitdown.convert(str(pdf_path))
+            if self.markitdown is None:
+                self.markitdown = markitdown.MarkItDown()
+            output = self.markitdown.convert(str(pdf_path)).text_content
             with open(output_path, "w", encoding="utf-8") as f:
                 f.write(output)
             logging.info(f"Markitdown converted {pdf_path.name}")
@@ -102,7 +222,7 @@ class PDFConverter:
             local_image_folder = output_path.parent / "images"
 
         # Convert with PyMuPDF, fallback to markitdown
-        output_path.parent.mkdir(parents=True, exist_ok=True)
+        ensure_dir(output_path.parent)
         success = self.convert_pdf_with_pymupdf(pdf_path, output_path,
                                                image_folder=local_image_folder)
 
@@ -111,11 +231,8 @@ class PDFConverter:
 
     def process_directory(self, source_dir: Path, output_dir: Path):
         """Process all PDFs in a directory recursively"""
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                if file.lower().endswith(".pdf"):
-                    pdf_path = Path(root) / file
-                    self.process_pdf(pdf_path, source_dir, output_dir)
+        for pdf_path in iter_pdf_files(source_dir):
+            self.process_pdf(pdf_path, source_dir, output_dir)
 
 
 if __name__ == "__main__":